@@ -0,0 +1,148 @@
+"""
+Append-only audit log of logins, failed codes and salary views.
+
+Handlers only put events on an in-memory queue; a background thread writes
+whatever has queued up every AUDIT_FLUSH_SECONDS in a single transaction.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+import config
+from tracing import trace_methods
+
+logger = logging.getLogger(__name__)
+
+# Event names
+LOGIN = "login"
+LOGIN_FAILED = "login_failed"
+ADMIN_LOGIN = "admin_login"
+ADMIN_LOGIN_FAILED = "admin_login_failed"
+SALARY_VIEW = "salary_view"
+HISTORY_VIEW = "history_view"
+
+
+@trace_methods("audit")
+class AuditLog:
+    def __init__(self, db_file: str = config.DATABASE_FILE):
+        self.db_file = db_file
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=config.AUDIT_QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._init_table()
+        self._writer = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_file, timeout=10)
+
+    def _init_table(self):
+        conn = self._connect()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS audit_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                event TEXT NOT NULL,
+                user_id INTEGER,
+                teacher_name TEXT,
+                branch TEXT,
+                detail TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_audit_event_ts ON audit_log (event, ts, user_id);
+            CREATE TRIGGER IF NOT EXISTS audit_log_no_update BEFORE UPDATE ON audit_log BEGIN
+                SELECT RAISE(ABORT, 'audit_log is append-only');
+            END;
+            CREATE TRIGGER IF NOT EXISTS audit_log_no_delete BEFORE DELETE ON audit_log BEGIN
+                SELECT RAISE(ABORT, 'audit_log is append-only');
+            END;
+        ''')
+        conn.commit()
+        conn.close()
+
+    def record(self, event: str, user_id: Optional[int], teacher_name: Optional[str] = None,
+               branch: Optional[str] = None, detail: Optional[str] = None):
+        """Queue an event. Never blocks; if the queue is full the event is dropped and counted"""
+        try:
+            self._queue.put_nowait((time.time(), event, user_id, teacher_name, branch, detail))
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self) -> list:
+        batch = []
+        while len(batch) < config.AUDIT_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list):
+        conn = self._connect()
+        try:
+            conn.executemany('''
+                INSERT INTO audit_log (ts, event, user_id, teacher_name, branch, detail)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', batch)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.wait(config.AUDIT_FLUSH_SECONDS):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """Write everything queued so far, one transaction per batch"""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            try:
+                self._write(batch)
+            except sqlite3.Error as e:
+                self.dropped += len(batch)
+                logger.error(f"Failed to write {len(batch)} audit event(s): {e}")
+
+    def close(self):
+        """Stop the writer after a final flush"""
+        if not self._stop.is_set():
+            self._stop.set()
+            self._writer.join(timeout=5)
+
+    def failed_attempts_by_user(self, since_seconds: float, limit: int = 10) -> List[Tuple[int, int, float]]:
+        """Failed teacher logins per Telegram user in the last since_seconds.
+        Returns list of (user_id, attempts, last_ts), most attempts first"""
+        conn = self._connect()
+        rows = conn.execute('''
+            SELECT user_id, COUNT(*), MAX(ts) FROM audit_log
+            WHERE event = ? AND ts >= ?
+            GROUP BY user_id
+            ORDER BY COUNT(*) DESC
+            LIMIT ?
+        ''', (LOGIN_FAILED, time.time() - since_seconds, limit)).fetchall()
+        conn.close()
+        return rows
+
+    def count_events(self, event: str, since_seconds: float) -> int:
+        """Number of events of one kind in the last since_seconds"""
+        conn = self._connect()
+        count = conn.execute(
+            'SELECT COUNT(*) FROM audit_log WHERE event = ? AND ts >= ?',
+            (event, time.time() - since_seconds)
+        ).fetchone()[0]
+        conn.close()
+        return count
+
+    def recent_events(self, limit: int = 10) -> List[Tuple[float, str, int, str]]:
+        """Latest events. Returns list of (ts, event, user_id, teacher_name), newest first"""
+        conn = self._connect()
+        rows = conn.execute('''
+            SELECT ts, event, user_id, teacher_name FROM audit_log
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (limit,)).fetchall()
+        conn.close()
+        return rows
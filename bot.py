@@ -2,6 +2,7 @@
 Main Telegram Bot for English Learning Center Salary Tracker
 """
 
+import asyncio
 import logging
 import os
 from dotenv import load_dotenv
@@ -15,26 +16,54 @@ from telegram.ext import (
     filters,
     ConversationHandler
 )
+import audit
+from audit import AuditLog
 from database import Database
-from sheets_handler import SheetsHandler
+from export import export_payroll
+from sheets_handler import SheetsRegistry, SheetFetchError, format_amount
+from snapshot import RefreshLock
+from state_store import create_state_store
+from tracing import trace_update, span, run_cprofile, sample_stacks
 import config
-from flask import Flask
+from flask import Flask, request as flask_request
+import io
+import signal
+import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from telegram.request import HTTPXRequest
+
+# Set by workers.py when running as one of several worker processes
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if "WORKER_INDEX" in os.environ else None
+
 # -------------------- FLASK KEEP-ALIVE (RENDER FIX) --------------------
 
 app = Flask(__name__)
 
+# In worker mode: the running application and its event loop, for forwarded updates
+worker_application = None
+worker_loop = None
+
 @app.route("/")
 def health():
     return "OK", 200
 
-def run_flask():
-    port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
-
-threading.Thread(target=run_flask, daemon=True).start()
+@app.route("/telegram-update", methods=["POST"])
+def telegram_update():
+    """Receive an update forwarded by workers.py and queue it for this worker"""
+    if worker_application is None:
+        return "Not ready", 503
+    update = Update.de_json(flask_request.get_json(force=True), worker_application.bot)
+    asyncio.run_coroutine_threadsafe(worker_application.update_queue.put(update), worker_loop)
+    return "OK", 200
 
+def run_flask():
+    if WORKER_INDEX is not None:
+        # Only workers.py talks to a worker, so stay on localhost
+        app.run(host="127.0.0.1", port=config.WORKER_BASE_PORT + WORKER_INDEX)
+    else:
+        port = int(os.environ.get("PORT", 10000))
+        app.run(host="0.0.0.0", port=port)
 
 load_dotenv()
 
@@ -54,27 +83,71 @@ TEACHER_MENU = 4
 CREATE_TEACHER_NAME = 5
 DELETE_TEACHER_NAME = 6
 RESET_CODE_NAME = 7
+SEARCH_TEACHER_NAME = 8
+CREATE_TEACHER_BRANCH = 9
+
+# Created in main(): the export pool's processes import this module and must not
+# open the database, start threads or serve Flask themselves
+db = None
+sheets_registry = None
 
-# Initialize database and sheets handler
-db = Database()
-sheets_handler = None
+# Logins, failed codes and salary views, written in the background
+audit_log = None
 
-# User states (tracking login attempts and current state)
-user_states = {}
+# User states (sessions and login attempts), shared between workers when STATE_STORE is "file"
+user_states = None
 
-def init_sheets_handler():
-    """Initialize SheetsHandler"""
-    global sheets_handler
+# Elects the worker that refreshes shared sheet snapshots
+refresh_lock = None
+
+# Archives refreshed sheets one at a time in the background, so the teacher whose
+# request fetched a changed sheet doesn't wait for it. Queued archives finish at exit
+archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="salary-archive")
+
+def init_sheets_registry():
+    """Initialize the per-branch SheetsRegistry"""
+    global sheets_registry
     try:
-        sheets_handler = SheetsHandler()
-        logger.info("SheetsHandler initialized successfully")
+        # Workers share sheets through snapshot files instead of each fetching them
+        snapshot_dir = config.SNAPSHOT_DIR if WORKER_INDEX is not None else None
+        sheets_registry = SheetsRegistry(snapshot_dir=snapshot_dir, on_refresh=archive_sheet)
+        logger.info(f"SheetsRegistry initialized with branches: {', '.join(sheets_registry.branch_ids())}")
     except Exception as e:
-        logger.warning(f"Failed to initialize SheetsHandler: {str(e)}")
+        logger.warning(f"Failed to initialize SheetsRegistry: {str(e)}")
         logger.warning("Bot will start but salary fetching will be unavailable")
-        sheets_handler = None
+        sheets_registry = None
+
+def archive_sheet(sheets_handler, data):
+    """Keep every refreshed sheet in the salary history archive (queued, see archive_executor)"""
+    archive_executor.submit(write_archive, sheets_handler, data)
+
+def write_archive(sheets_handler, data):
+    try:
+        rows = sheets_handler.extract_all_rows(data)
+        db.archive_salary_rows(sheets_handler.branch, sheet_month(sheets_handler), rows)
+    except Exception as e:
+        logger.warning(f"Archiving the sheet of branch {sheets_handler.branch} failed: {e}")
+
+def sheet_month(sheets_handler) -> str:
+    """Month the branch's current tab holds: its "month" setting, else the month the tab was first fetched.
+    Keyed by the tab, so last month's tab fetched early this month stays last month's"""
+    return sheets_handler.month or db.get_sheet_month(sheets_handler.spreadsheet_id, sheets_handler.sheet_gid)
+
+def format_history(history, with_change=False) -> str:
+    """One line per (month, data) entry, optionally with the salary change from the month before"""
+    lines = []
+    for i, (month, data) in enumerate(history):
+        line = f"📅 {month}: 💰 {format_amount(data['salary'])} | 🏁 {format_amount(data['remains'])}"
+        if with_change and i + 1 < len(history):
+            change = data["salary"] - history[i + 1][1]["salary"]
+            if change:
+                line += f" ({'+' if change > 0 else '-'}{format_amount(abs(change))})"
+        lines.append(line)
+    return "\n".join(lines)
 
 # -------------------- START & BUTTONS --------------------
 
+@trace_update
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user_id = update.effective_user.id
@@ -100,6 +173,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     return CHOOSING_ROLE
 
+@trace_update
 async def role_selection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the first button click after /start"""
     query = update.callback_query
@@ -113,6 +187,7 @@ async def role_selection_callback(update: Update, context: ContextTypes.DEFAULT_
         return WAITING_FOR_TEACHER_CODE
     return CHOOSING_ROLE
 
+@trace_update
 async def admin_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles buttons pressed while in the ADMIN_MENU state"""
     query = update.callback_query
@@ -130,8 +205,36 @@ async def admin_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
         return RESET_CODE_NAME
     elif data == "list_teachers":
         return await list_all_teachers(update, context)
+    elif data in ("teachers_next", "teachers_prev", "teachers_page"):
+        return await list_all_teachers(update, context, direction=data)
+    elif data == "search_teachers":
+        await query.edit_message_text("Enter the teacher's name (or part of it):")
+        return SEARCH_TEACHER_NAME
+    elif data.startswith("teacher:"):
+        return await show_teacher_details(update, context, int(data.split(":", 1)[1]))
+    elif data.startswith("teacher_reset:"):
+        return await reset_teacher_code(update, context, int(data.split(":", 1)[1]))
+    elif data.startswith("teacher_delete:"):
+        return await confirm_delete_teacher(update, context, int(data.split(":", 1)[1]))
+    elif data.startswith("teacher_trend:"):
+        return await show_teacher_trend(update, context, int(data.split(":", 1)[1]))
+    elif data.startswith("teacher_delete_yes:"):
+        return await delete_teacher_by_id(update, context, int(data.split(":", 1)[1]))
     elif data == "backup_db":
         return await backup_database(update, context)
+    elif data == "sheets_status":
+        return await show_sheets_status(update, context)
+    elif data == "audit_log":
+        return await show_audit_log(update, context)
+    elif data == "export_payroll":
+        if len(config.BRANCHES) > 1:
+            keyboard = [[InlineKeyboardButton(b, callback_data=f"export:{b}")] for b in config.BRANCHES]
+            keyboard.append([InlineKeyboardButton("Back to Menu", callback_data="admin_menu")])
+            await query.edit_message_text("Export payroll of which branch?", reply_markup=InlineKeyboardMarkup(keyboard))
+            return ADMIN_MENU
+        return await send_payroll_export(update, context, config.DEFAULT_BRANCH)
+    elif data.startswith("export:"):
+        return await send_payroll_export(update, context, data.split(":", 1)[1])
     elif data == "admin_logout":
         return await admin_logout(update, context)
     elif data == "admin_menu":
@@ -139,6 +242,7 @@ async def admin_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
         return ADMIN_MENU
     return ADMIN_MENU
 
+@trace_update
 async def teacher_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles buttons pressed while in the TEACHER_MENU state"""
     query = update.callback_query
@@ -146,9 +250,9 @@ async def teacher_button_callback(update: Update, context: ContextTypes.DEFAULT_
     data = query.data
 
     if data == "my_salary":
-
-        await get_my_salary(update, context)
-        return TEACHER_MENU
+        return await get_my_salary(update, context)
+    elif data == "my_history":
+        return await show_my_history(update, context)
     elif data == "teacher_logout":
         return await teacher_logout(update, context)
     elif data == "teacher_menu":
@@ -158,25 +262,40 @@ async def teacher_button_callback(update: Update, context: ContextTypes.DEFAULT_
 
 # -------------------- ADMIN HANDLERS --------------------
 
+@trace_update
 async def handle_admin_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     password = update.message.text.strip()
 
     if password == config.ADMIN_PASSWORD:
-        user_states[user_id] = {"role": "admin"}
+        user_states.set(user_id, {"role": "admin"})
+        audit_log.record(audit.ADMIN_LOGIN, user_id)
         await update.message.reply_text("✅ Admin access granted!")
         await show_admin_menu(update, context, from_message=True)
         return ADMIN_MENU
     else:
+        audit_log.record(audit.ADMIN_LOGIN_FAILED, user_id)
         await update.message.reply_text("❌ Incorrect password. Try again or /cancel.")
         return WAITING_FOR_ADMIN_PASSWORD
 
+@trace_update
 async def handle_create_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in user_states or user_states[user_id].get("role") != "admin":
+    state = user_states.get(user_id)
+    if state.get("role") != "admin":
         return ConversationHandler.END
 
     teacher_name = update.message.text.strip()
+    if len(config.BRANCHES) > 1:
+        # Ask which branch the teacher belongs to before creating the account
+        state["pending_teacher_name"] = teacher_name
+        user_states.set(user_id, state)
+        keyboard = [[InlineKeyboardButton(b, callback_data=f"branch:{b}")] for b in config.BRANCHES]
+        await update.message.reply_text(
+            f"Select the branch for {teacher_name}:", reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return CREATE_TEACHER_BRANCH
+
     access_code = db.create_teacher(teacher_name)
     await update.message.reply_text(
         f"✅ Teacher account created!\n\nName: {teacher_name}\nAccess Code: {access_code}"
@@ -184,33 +303,208 @@ async def handle_create_teacher(update: Update, context: ContextTypes.DEFAULT_TY
     await show_admin_menu(update, context, from_message=True)
     return ADMIN_MENU
 
+@trace_update
+async def handle_create_teacher_branch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_user.id
+    state = user_states.get(user_id)
+    if state.get("role") != "admin":
+        return ConversationHandler.END
+
+    branch = query.data.split(":", 1)[1]
+    teacher_name = state.pop("pending_teacher_name", None)
+    user_states.set(user_id, state)
+    if not teacher_name or branch not in config.BRANCHES:
+        await show_admin_menu(update, context)
+        return ADMIN_MENU
+
+    access_code = db.create_teacher(teacher_name, branch)
+    keyboard = [[InlineKeyboardButton("Back to Menu", callback_data="admin_menu")]]
+    await query.edit_message_text(
+        f"✅ Teacher account created!\n\nName: {teacher_name}\nBranch: {branch}\nAccess Code: {access_code}",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return ADMIN_MENU
+
+@trace_update
 async def handle_delete_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     teacher_name = update.message.text.strip()
     if db.delete_teacher(teacher_name):
         await update.message.reply_text(f"✅ Teacher '{teacher_name}' deleted.")
     else:
-        await update.message.reply_text(f"❌ Teacher '{teacher_name}' not found.")
+        await reply_teacher_not_found(update, teacher_name)
+        return ADMIN_MENU
     await show_admin_menu(update, context, from_message=True)
     return ADMIN_MENU
 
+@trace_update
 async def handle_reset_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     teacher_name = update.message.text.strip()
     new_code = db.reset_access_code(teacher_name)
     if new_code:
         await update.message.reply_text(f"✅ Code reset for {teacher_name}: {new_code}")
     else:
-        await update.message.reply_text(f"❌ Teacher '{teacher_name}' not found.")
+        await reply_teacher_not_found(update, teacher_name)
+        return ADMIN_MENU
     await show_admin_menu(update, context, from_message=True)
     return ADMIN_MENU
 
-async def list_all_teachers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    teachers = db.get_all_teachers()
-    message = "📋 All Teachers:\n\n" + "\n".join([f"{n}: {c}" for n, c in teachers]) if teachers else "No teachers found."
-    keyboard = [[InlineKeyboardButton("Back to Menu", callback_data="admin_menu")]]
+async def reply_teacher_not_found(update: Update, teacher_name: str):
+    """Tell the admin a typed name was not found and offer close matches as buttons"""
+    matches = db.search_teachers(teacher_name, limit=config.TEACHER_SEARCH_LIMIT)
+    keyboard = teacher_buttons(matches)
+    keyboard.append([InlineKeyboardButton("Back to Menu", callback_data="admin_menu")])
+    text = f"❌ Teacher '{teacher_name}' not found."
+    if matches:
+        text += "\n\nDid you mean one of these?"
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+def teacher_buttons(teachers):
+    """One button per (id, name) row, opening that teacher's details"""
+    return [[InlineKeyboardButton(name, callback_data=f"teacher:{teacher_id}")] for teacher_id, name in teachers]
+
+@trace_update
+async def list_all_teachers(update: Update, context: ContextTypes.DEFAULT_TYPE, direction=None):
+    """Show one page of teachers. The page cursor is kept per admin in user_states"""
+    user_id = update.effective_user.id
+    state = user_states.get(user_id)
+    cursor = state.get("teacher_page", {})
+
+    if direction == "teachers_next" and cursor:
+        page = {"after": cursor["last"]}
+    elif direction == "teachers_prev" and cursor:
+        page = {"before": cursor["first"]}
+    elif direction == "teachers_page" and cursor:
+        page = {k: v for k, v in cursor.items() if k in ("after", "before")}
+    else:
+        page = {}
+
+    limit = config.TEACHERS_PAGE_SIZE
+    if "before" in page:
+        teachers, has_prev = db.get_teachers_page(before=page["before"], limit=limit)
+        has_next = True
+    else:
+        teachers, has_next = db.get_teachers_page(after=page.get("after"), limit=limit)
+        has_prev = "after" in page
+
+    if not teachers and page:
+        # The page emptied (e.g. teachers were deleted), start over from the top
+        page = {}
+        teachers, has_next = db.get_teachers_page(limit=limit)
+        has_prev = False
+
+    keyboard = teacher_buttons(teachers)
+    if teachers:
+        # Cursors are (name, id): names may differ only in case
+        state["teacher_page"] = {
+            **page,
+            "first": [teachers[0][1], teachers[0][0]],
+            "last": [teachers[-1][1], teachers[-1][0]],
+        }
+        message = "📋 Teachers (tap a name to manage):"
+    else:
+        state.pop("teacher_page", None)
+        message = "No teachers found."
+    user_states.set(user_id, state)
+
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data="teachers_prev"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ▶️", callback_data="teachers_next"))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔎 Search", callback_data="search_teachers")])
+    keyboard.append([InlineKeyboardButton("Back to Menu", callback_data="admin_menu")])
+    await update.callback_query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+    return ADMIN_MENU
+
+@trace_update
+async def handle_search_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_states.get(user_id).get("role") != "admin":
+        return ConversationHandler.END
+
+    search = update.message.text.strip()
+    matches = db.search_teachers(search, limit=config.TEACHER_SEARCH_LIMIT)
+    keyboard = teacher_buttons(matches)
+    keyboard.append([InlineKeyboardButton("🔎 New Search", callback_data="search_teachers")])
+    keyboard.append([InlineKeyboardButton("Back to Menu", callback_data="admin_menu")])
+    text = f"🔎 Results for '{search}':" if matches else f"❌ No teachers match '{search}'."
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    return ADMIN_MENU
+
+@trace_update
+async def show_teacher_details(update: Update, context: ContextTypes.DEFAULT_TYPE, teacher_id: int):
+    teacher = db.get_teacher_by_id(teacher_id)
+    if not teacher:
+        return await list_all_teachers(update, context, direction="teachers_page")
+
+    name, access_code, is_blocked, branch = teacher
+    status = "🔒 Blocked" if is_blocked else "✅ Active"
+    keyboard = [
+        [InlineKeyboardButton("📈 Salary Trend", callback_data=f"teacher_trend:{teacher_id}")],
+        [InlineKeyboardButton("Reset Code", callback_data=f"teacher_reset:{teacher_id}")],
+        [InlineKeyboardButton("Delete Teacher", callback_data=f"teacher_delete:{teacher_id}")],
+        [InlineKeyboardButton("Back to List", callback_data="teachers_page")],
+    ]
+    await update.callback_query.edit_message_text(
+        f"👤 {name}\nBranch: {branch}\nAccess Code: {access_code}\nStatus: {status}",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return ADMIN_MENU
+
+@trace_update
+async def reset_teacher_code(update: Update, context: ContextTypes.DEFAULT_TYPE, teacher_id: int):
+    teacher = db.get_teacher_by_id(teacher_id)
+    new_code = db.reset_access_code(teacher[0]) if teacher else None
+    message = f"✅ Code reset for {teacher[0]}: {new_code}" if new_code else "❌ Teacher not found."
+    keyboard = [[InlineKeyboardButton("Back to List", callback_data="teachers_page")]]
+    await update.callback_query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+    return ADMIN_MENU
+
+@trace_update
+async def show_teacher_trend(update: Update, context: ContextTypes.DEFAULT_TYPE, teacher_id: int):
+    teacher = db.get_teacher_by_id(teacher_id)
+    if not teacher:
+        return await list_all_teachers(update, context, direction="teachers_page")
+
+    name, _, _, branch = teacher
+    history = db.get_salary_history(name, branch, limit=config.TREND_MONTHS)
+    if history:
+        message = f"📈 Salary trend for {name}:\n\n" + format_history(history, with_change=True)
+    else:
+        message = f"No archived salary data for {name} yet."
+    keyboard = [[InlineKeyboardButton("Back", callback_data=f"teacher:{teacher_id}")]]
     await update.callback_query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
     return ADMIN_MENU
 
+@trace_update
+async def confirm_delete_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE, teacher_id: int):
+    teacher = db.get_teacher_by_id(teacher_id)
+    if not teacher:
+        return await list_all_teachers(update, context, direction="teachers_page")
+    keyboard = [
+        [InlineKeyboardButton("Yes, delete", callback_data=f"teacher_delete_yes:{teacher_id}")],
+        [InlineKeyboardButton("Cancel", callback_data=f"teacher:{teacher_id}")],
+    ]
+    await update.callback_query.edit_message_text(
+        f"Delete teacher '{teacher[0]}'?", reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return ADMIN_MENU
+
+@trace_update
+async def delete_teacher_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE, teacher_id: int):
+    teacher = db.get_teacher_by_id(teacher_id)
+    deleted = db.delete_teacher(teacher[0]) if teacher else False
+    message = f"✅ Teacher '{teacher[0]}' deleted." if deleted else "❌ Teacher not found."
+    keyboard = [[InlineKeyboardButton("Back to List", callback_data="teachers_page")]]
+    await update.callback_query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+    return ADMIN_MENU
+
+@trace_update
 async def backup_database(update: Update, context: ContextTypes.DEFAULT_TYPE):
     backup_path = db.create_backup()
     message = f"✅ Backup created: {os.path.basename(backup_path)}" if backup_path else "❌ Backup failed."
@@ -218,24 +512,130 @@ async def backup_database(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
     return ADMIN_MENU
 
-# -------------------- TEACHER HANDLERS --------------------
+@trace_update
+async def show_sheets_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Circuit breaker state and data age of every branch sheet in use"""
+    statuses = sheets_registry.status() if sheets_registry else {}
+    icons = {"closed": "🟢", "half-open": "🟡", "open": "🔴"}
+    lines = []
+    for branch, status in statuses.items():
+        line = f"{icons.get(status['state'], '')} {branch}: {status['state']}, {status['failures']} failure(s)"
+        if status["retry_in"] is not None:
+            line += f", retry in {int(status['retry_in'])}s"
+        if status["data_age"] is not None:
+            line += f", data {int(status['data_age'])}s old"
+        line += f", hedge after {status['hedge_after']:.1f}s"
+        lines.append(line)
+    message = "📡 Sheets Status:\n\n" + "\n".join(lines) if lines else "No branch sheet has been used yet."
+    keyboard = [
+        [InlineKeyboardButton("🔄 Refresh", callback_data="sheets_status")],
+        [InlineKeyboardButton("Back to Menu", callback_data="admin_menu")]
+    ]
+    try:
+        await update.callback_query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+    except Exception as e:
+        if "Message is not modified" not in str(e):
+            raise e
+    return ADMIN_MENU
+
+@trace_update
+async def show_audit_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Login and salary view counts, repeated failed codes and the latest events"""
+    day, hour = 24 * 3600, 3600
+
+    def read_audit():
+        counts = {event: audit_log.count_events(event, day) for event in (audit.LOGIN, audit.LOGIN_FAILED, audit.SALARY_VIEW)}
+        return counts, audit_log.failed_attempts_by_user(hour), audit_log.recent_events(10)
+
+    counts, failed, recent = await asyncio.to_thread(read_audit)
+
+    lines = [
+        "🛡 Audit Log",
+        "",
+        f"Last 24h: {counts[audit.LOGIN]} login(s), {counts[audit.LOGIN_FAILED]} failed code(s), "
+        f"{counts[audit.SALARY_VIEW]} salary view(s)",
+        "",
+        "Failed codes in the last hour:",
+    ]
+    for user_id, attempts, last_ts in failed:
+        lines.append(f"👤 {user_id}: {attempts} attempt(s), last {time.strftime('%H:%M', time.localtime(last_ts))}")
+    if not failed:
+        lines.append("None")
+    lines += ["", "Latest events:"]
+    for ts, event, user_id, teacher_name in recent:
+        line = f"{time.strftime('%d.%m %H:%M', time.localtime(ts))} {event} · {user_id}"
+        if teacher_name:
+            line += f" ({teacher_name})"
+        lines.append(line)
+    if not recent:
+        lines.append("None")
+    if audit_log.dropped:
+        lines += ["", f"⚠️ {audit_log.dropped} event(s) could not be recorded"]
+
+    keyboard = [
+        [InlineKeyboardButton("🔄 Refresh", callback_data="audit_log")],
+        [InlineKeyboardButton("Back to Menu", callback_data="admin_menu")]
+    ]
+    try:
+        await update.callback_query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+    except Exception as e:
+        if "Message is not modified" not in str(e):
+            raise e
+    return ADMIN_MENU
+
+@trace_update
+async def send_payroll_export(update: Update, context: ContextTypes.DEFAULT_TYPE, branch: str):
+    """Send every teacher's slip of a branch as one ZIP (CSV + text slips)"""
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Back to Menu", callback_data="admin_menu")]])
+    try:
+        sheets_handler = sheets_registry.get(branch) if sheets_registry else None
+    except KeyError:
+        sheets_handler = None
+    if not sheets_handler:
+        await update.callback_query.edit_message_text("❌ Salary service unavailable.", reply_markup=keyboard)
+        return ADMIN_MENU
+
+    await update.callback_query.edit_message_text("⏳ Preparing payroll export...")
+    zip_path = None
+    try:
+        # Sheet fetch and rendering run off the event loop so other users aren't blocked
+        def load_rows():
+            data, _ = sheets_handler.get_all_data()
+            return sheets_handler.extract_all_rows(data)
+
+        rows = await asyncio.to_thread(load_rows)
+        month = await asyncio.to_thread(sheet_month, sheets_handler)
+        zip_path = await asyncio.to_thread(export_payroll, rows, branch, month)
+        with open(zip_path, "rb") as document:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=document,
+                filename=f"payroll_{branch}_{month}.zip",
+                caption=f"📦 Payroll {branch} {month}: {len(rows)} teacher(s)"
+            )
+        await update.callback_query.edit_message_text("✅ Payroll export sent.", reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Error in send_payroll_export: {e}")
+        await update.callback_query.edit_message_text("❌ Export failed.", reply_markup=keyboard)
+    finally:
+        if zip_path: os.remove(zip_path)
+    return ADMIN_MENU
 
 # -------------------- TEACHER HANDLERS --------------------
 
+@trace_update
 async def handle_teacher_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     access_code = update.message.text.strip().upper()
 
-    if user_id not in user_states:
-        user_states[user_id] = {"attempts": 0}
-
-    attempts = user_states[user_id].get("attempts", 0)
     teacher_info = db.get_teacher_by_code(access_code)
 
     if teacher_info:
         # 1. Save teacher info
-        teacher_id, teacher_name = teacher_info
-        user_states[user_id] = {"role": "teacher", "teacher_name": teacher_name}
+        teacher_id, teacher_name, branch = teacher_info
+        user_states.set(user_id, {"role": "teacher", "teacher_name": teacher_name, "branch": branch})
+        user_states.reset_attempts(user_id)
+        audit_log.record(audit.LOGIN, user_id, teacher_name, branch)
         
         # 2. Skip the menu and show salary IMMEDIATELY
         await update.message.reply_text(f"✅ Code accepted! Fetching details for {teacher_name}...")
@@ -243,8 +643,8 @@ async def handle_teacher_code(update: Update, context: ContextTypes.DEFAULT_TYPE
         # We call get_my_salary and tell it we are coming from a message login
         return await get_my_salary(update, context, from_login=True)
     else:
-        attempts += 1
-        user_states[user_id]["attempts"] = attempts
+        attempts = user_states.increment_attempts(user_id)
+        audit_log.record(audit.LOGIN_FAILED, user_id, detail=f"attempt {attempts}")
         remaining = config.MAX_LOGIN_ATTEMPTS - attempts
         if remaining <= 0:
             await update.message.reply_text("❌ Too many attempts. Locked.")
@@ -252,14 +652,22 @@ async def handle_teacher_code(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text(f"❌ Incorrect code. {remaining} left.")
         return WAITING_FOR_TEACHER_CODE
 
+@trace_update
 async def get_my_salary(update: Update, context: ContextTypes.DEFAULT_TYPE, from_login=False):
     user_id = update.effective_user.id
-    teacher_name = user_states[user_id].get("teacher_name")
+    state = user_states.get(user_id)
+    teacher_name = state.get("teacher_name")
     
     if not teacher_name:
-        await update.message.reply_text("❌ Session expired. Please /start again.")
+        msg = "❌ Session expired. Please /start again."
+        if from_login: await update.message.reply_text(msg)
+        else: await update.callback_query.edit_message_text(msg)
         return ConversationHandler.END
 
+    try:
+        sheets_handler = sheets_registry.get(state.get("branch")) if sheets_registry else None
+    except KeyError:
+        sheets_handler = None
     if not sheets_handler:
         msg = "❌ Salary service unavailable."
         if from_login: await update.message.reply_text(msg)
@@ -267,19 +675,24 @@ async def get_my_salary(update: Update, context: ContextTypes.DEFAULT_TYPE, from
         return TEACHER_MENU
 
     try:
-        salary_data = sheets_handler.find_teacher_row(teacher_name)
+        # Fetch off the event loop so other users aren't blocked by a slow sheet
+        salary_data, stale_age = await asyncio.to_thread(sheets_handler.find_teacher_row, teacher_name)
         
         if salary_data:
             message_text = sheets_handler.format_salary_message(salary_data)
+            audit_log.record(audit.SALARY_VIEW, user_id, teacher_name, state.get("branch"))
             
             # Buttons to Refresh data or Logout
             keyboard = [
                 [InlineKeyboardButton("🔄 Refresh Data", callback_data="my_salary")],
+                [InlineKeyboardButton("📜 History", callback_data="my_history")],
                 [InlineKeyboardButton("🚪 Logout", callback_data="teacher_logout")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             full_text = f"💰 **Your Salary Details:**\n\n{message_text}"
+            if stale_age is not None:
+                full_text += f"\n\n⚠️ Google Sheets is not reachable right now, showing data from {int(stale_age // 60)} min ago."
             
             if from_login:
                 # If they just entered their code, send a NEW message
@@ -300,46 +713,90 @@ async def get_my_salary(update: Update, context: ContextTypes.DEFAULT_TYPE, from
             
     except Exception as e:
         logger.error(f"Error in get_my_salary: {e}")
+        if isinstance(e, SheetFetchError):
+            error_msg = "⚠️ Couldn't reach the salary sheet. Please try again in a few minutes."
+        else:
+            error_msg = "❌ Something went wrong while loading your salary. Please try again."
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Try Again", callback_data="my_salary")],
+            [InlineKeyboardButton("🚪 Logout", callback_data="teacher_logout")]
+        ])
+        try:
+            if from_login: await update.message.reply_text(error_msg, reply_markup=keyboard)
+            else: await update.callback_query.edit_message_text(error_msg, reply_markup=keyboard)
+        except Exception as reply_error:
+            logger.error(f"Could not send error reply: {reply_error}")
         
     return TEACHER_MENU
 
+@trace_update
+async def show_my_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the teacher's last months from the archive, without touching the sheet"""
+    user_id = update.effective_user.id
+    state = user_states.get(user_id)
+    teacher_name = state.get("teacher_name")
+    if not teacher_name:
+        await update.callback_query.edit_message_text("❌ Session expired. Please /start again.")
+        return ConversationHandler.END
+
+    audit_log.record(audit.HISTORY_VIEW, user_id, teacher_name, state.get("branch"))
+    history = db.get_salary_history(teacher_name, state.get("branch", config.DEFAULT_BRANCH), limit=config.HISTORY_MONTHS)
+    if history:
+        message = f"📜 Your last {len(history)} month(s):\n\n" + format_history(history)
+    else:
+        message = "No salary history yet."
+    keyboard = [[InlineKeyboardButton("Back", callback_data="my_salary")]]
+    await update.callback_query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+    return TEACHER_MENU
+
+# -------------------- PROFILING --------------------
+
+@trace_update
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [seconds] [sample] - admin only. Profiles the bot and sends the top functions"""
+    if user_states.get(update.effective_user.id).get("role") != "admin":
+        await update.message.reply_text("❌ Admins only.")
+        return
+
+    args = context.args or []
     try:
-        salary_data = sheets_handler.find_teacher_row(teacher_name)
-        
-        if salary_data:
-            message = sheets_handler.format_salary_message(salary_data)
-            keyboard = [[InlineKeyboardButton("Back to Menu", callback_data="teacher_menu")]]
-            
-            # THE FIX: Wrap the edit in a try block
-            try:
-                await update.callback_query.edit_message_text(
-                    f"💰 **Your Salary Details:**\n\n{message}", 
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                # If the error is about "Message is not modified", just ignore it
-                if "Message is not modified" in str(e):
-                    await update.callback_query.answer("Data is already up to date!")
-                else:
-                    raise e
+        seconds = min(max(float(args[0]), 1), config.PROFILE_MAX_SECONDS) if args else 10
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [seconds] [sample]")
+        return
+    sampling = "sample" in args[1:]
+
+    await update.message.reply_text(
+        f"⏳ {'Sampling all threads' if sampling else 'Running cProfile'} for {seconds:g}s..."
+    )
+    try:
+        if sampling:
+            report = await asyncio.to_thread(sample_stacks, seconds)
         else:
-            await update.callback_query.edit_message_text(
-                f"❌ Data for '{teacher_name}' not found in the current sheet tab."
-            )
-    except Exception as e:
-        # Check if the query was already answered to avoid crash
-        print(f"Error in get_my_salary: {e}")
+            report = await run_cprofile(seconds)
+    except RuntimeError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+
+    await update.message.reply_document(
+        document=io.BytesIO(report.encode("utf-8")),
+        filename=f"profile_{'sample' if sampling else 'cprofile'}_{int(seconds)}s.txt"
+    )
 
 # -------------------- OTHER --------------------
 
+@trace_update
 async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, from_message=False):
     keyboard = [
         [InlineKeyboardButton("Create Teacher", callback_data="create_teacher")],
         [InlineKeyboardButton("Delete Teacher", callback_data="delete_teacher")],
         [InlineKeyboardButton("Reset Code", callback_data="reset_code")],
         [InlineKeyboardButton("List Teachers", callback_data="list_teachers")],
+        [InlineKeyboardButton("Search Teachers", callback_data="search_teachers")],
         [InlineKeyboardButton("Backup DB", callback_data="backup_db")],
+        [InlineKeyboardButton("Export Payroll", callback_data="export_payroll")],
+        [InlineKeyboardButton("Sheets Status", callback_data="sheets_status")],
+        [InlineKeyboardButton("Audit Log", callback_data="audit_log")],
         [InlineKeyboardButton("Logout", callback_data="admin_logout")]
     ]
     markup = InlineKeyboardMarkup(keyboard)
@@ -347,6 +804,7 @@ async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, fr
     if from_message: await update.message.reply_text(text, reply_markup=markup)
     else: await update.callback_query.edit_message_text(text, reply_markup=markup)
 
+@trace_update
 async def show_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, from_message=False):
     keyboard = [
         [InlineKeyboardButton("My Salary", callback_data="my_salary")],
@@ -357,43 +815,85 @@ async def show_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
     if from_message: await update.message.reply_text(text, reply_markup=markup)
     else: await update.callback_query.edit_message_text(text, reply_markup=markup)
 
+@trace_update
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id in user_states: del user_states[user_id]
+    user_states.delete(user_id)
     await update.message.reply_text("Cancelled. /start to restart.")
     return ConversationHandler.END
 
+@trace_update
 async def admin_logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id in user_states: del user_states[user_id]
+    user_states.delete(user_id)
     return await start(update, context)
 
+@trace_update
 async def teacher_logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id in user_states: del user_states[user_id]
+    user_states.delete(user_id)
     return await start(update, context)
 
 async def periodic_backup(context: ContextTypes.DEFAULT_TYPE):
     if config.BACKUP_ENABLED: db.create_backup()
 
+async def evict_idle_sheets(context: ContextTypes.DEFAULT_TYPE):
+    if sheets_registry:
+        dropped = sheets_registry.evict_idle(config.SHEET_IDLE_EVICT_SECONDS)
+        if dropped: logger.info(f"Dropped cached sheets of {dropped} idle branch(es)")
+
+async def refresh_shared_snapshots(context: ContextTypes.DEFAULT_TYPE):
+    """In worker mode, the worker holding the refresh lock publishes sheet snapshots"""
+    if sheets_registry and refresh_lock.try_acquire():
+        published = await asyncio.to_thread(sheets_registry.refresh_snapshots)
+        if published: logger.info(f"Published snapshots for: {', '.join(published)}")
+
+async def run_worker(application: Application):
+    """Run without polling; updates arrive from workers.py through /telegram-update"""
+    global worker_application, worker_loop
+    async with application:
+        await application.start()
+        worker_loop = asyncio.get_running_loop()
+        worker_application = application
+        logger.info(f"Worker {WORKER_INDEX} ready on port {config.WORKER_BASE_PORT + WORKER_INDEX}")
+
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            worker_loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+
+        worker_application = None
+        await application.stop()
+
 # -------------------- MAIN --------------------
 
-def main():
-    init_sheets_handler()
+class TracedHTTPXRequest(HTTPXRequest):
+    """Records each Telegram API call as a span of the current update's trace"""
 
-    request = HTTPXRequest(
+    async def do_request(self, url, method, *args, **kwargs):
+        with span(f"telegram.{url.rsplit('/', 1)[-1]}"):
+            return await super().do_request(url, method, *args, **kwargs)
+
+def main():
+    global db, audit_log, user_states, refresh_lock
+    db = Database()
+    audit_log = AuditLog()
+    user_states = create_state_store()
+    threading.Thread(target=run_flask, daemon=True).start()
+    init_sheets_registry()
+
+    request = TracedHTTPXRequest(
         connect_timeout=30,
         read_timeout=30,
         write_timeout=30,
         pool_timeout=30
     )
 
-    application = (
-        Application.builder()
-        .token(os.getenv("BOT_TOKEN"))
-        .request(request)
-        .build()
-    )
+    builder = Application.builder().token(os.getenv("BOT_TOKEN")).request(request)
+    if WORKER_INDEX is not None:
+        # workers.py polls Telegram and forwards each user's updates to one worker
+        builder = builder.updater(None)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -406,21 +906,42 @@ def main():
             CREATE_TEACHER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_create_teacher)],
             DELETE_TEACHER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_delete_teacher)],
             RESET_CODE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_reset_code)],
+            SEARCH_TEACHER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_search_teacher)],
+            CREATE_TEACHER_BRANCH: [CallbackQueryHandler(handle_create_teacher_branch, pattern="^branch:")],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         allow_reentry=True
     )
 
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("profile", profile_command))
 
-    if config.BACKUP_ENABLED:
+    # With several workers only the first one takes backups
+    if config.BACKUP_ENABLED and not WORKER_INDEX:
         application.job_queue.run_repeating(
             periodic_backup,
             interval=config.BACKUP_INTERVAL_HOURS * 3600,
             first=10
         )
 
-    application.run_polling()
+    application.job_queue.run_repeating(
+        evict_idle_sheets,
+        interval=config.SHEET_IDLE_EVICT_SECONDS,
+        first=config.SHEET_IDLE_EVICT_SECONDS
+    )
+
+    try:
+        if WORKER_INDEX is None:
+            application.run_polling()
+            return
+
+        refresh_lock = RefreshLock(os.path.join(config.SNAPSHOT_DIR, "refresh.lock"), WORKER_INDEX)
+        # Checked often; each branch's refresh_seconds decides when its snapshot is due
+        application.job_queue.run_repeating(refresh_shared_snapshots, interval=10, first=1)
+        asyncio.run(run_worker(application))
+    finally:
+        # Write the audit events still queued
+        audit_log.close()
 
 
 if __name__ == "__main__":
@@ -14,6 +14,35 @@ ADMIN_PASSWORD = "admin123"
 SPREADSHEET_ID = "1ONPOESz0sbB8Wmbk3HfuurC0RlrpqXaQU2Pe7Pt3LAQ"
 SHEET_GID = "1353280152" # <--- Change this for new tabs (e.g., February)
 
+# Branches: each branch has its own payroll spreadsheet.
+# Optional per-branch keys override the defaults below:
+#   "refresh_seconds"         - how long fetched sheet data is reused
+#   "max_concurrent_fetches"  - how many fetches of this sheet may run at once
+#   "month"                   - month the current tab holds, e.g. "2026-01" (default: the month
+#                               this spreadsheet/tab was first fetched)
+# Example of a second branch:
+#   "north": {"spreadsheet_id": "...", "sheet_gid": "...", "refresh_seconds": 120},
+BRANCHES = {
+    "main": {
+        "spreadsheet_id": SPREADSHEET_ID,
+        "sheet_gid": SHEET_GID,
+    },
+}
+DEFAULT_BRANCH = "main"
+SHEET_REFRESH_SECONDS = 60          # Default cache lifetime of a branch's sheet data
+SHEET_MAX_CONCURRENT_FETCHES = 1    # Default concurrent fetches per branch
+SHEET_IDLE_EVICT_SECONDS = 3600     # Drop a branch's cached sheet after this long unused
+
+# Sheet fetching resilience
+SHEET_FETCH_DEADLINE_SECONDS = 15   # Total time one request may spend fetching, retries included
+SHEET_FETCH_RETRIES = 3             # Attempts per fetch, within the deadline
+SHEET_RETRY_BASE_SECONDS = 0.5      # Retry n waits a random time up to base * 2^n
+SHEET_HEDGE_PERCENTILE = 90         # Send a second request once the first is slower than this latency percentile
+SHEET_HEDGE_MIN_SECONDS = 1.0       # ...but never sooner than this
+SHEET_HEDGE_DEFAULT_SECONDS = 3.0   # Hedge delay until enough latencies were measured
+BREAKER_FAILURE_THRESHOLD = 5       # Failed requests in a row before calls to Google stop
+BREAKER_RESET_SECONDS = 60          # How long calls stay stopped before a trial request
+
 # Column mapping (A=0, B=1, C=2, etc.)
 # If you add columns to your sheet, update these numbers!
 # config.py
@@ -30,6 +59,8 @@ COLUMN_MAPPING = {
     "tax": 8,           # Column I
     "remains": 9        # Column J
 }
+# Rows with one of these names (any case) are totals/labels, not teachers
+SUMMARY_ROW_NAMES = ("total", "jami", "итого")
 
 # Security and DB settings
 MAX_LOGIN_ATTEMPTS = 5
@@ -37,4 +68,34 @@ ACCESS_CODE_LENGTH = 8
 DATABASE_FILE = "teachers.db"
 BACKUP_DIR = "backups"
 BACKUP_ENABLED = True
-BACKUP_INTERVAL_HOURS = 24
\ No newline at end of file
+BACKUP_INTERVAL_HOURS = 24
+
+# Admin teacher list
+TEACHERS_PAGE_SIZE = 10     # Teachers shown per page in "List Teachers"
+TEACHER_SEARCH_LIMIT = 10   # Max results shown for a name search
+
+# Salary history (archived from every sheet refresh)
+HISTORY_MONTHS = 6          # Months shown in a teacher's "History"
+TREND_MONTHS = 12           # Months shown in the admin's per-teacher trend
+
+# Running several worker processes (see workers.py)
+STATE_STORE = os.environ.get("STATE_STORE", "memory")  # "memory" (one process) or "file" (shared)
+STATE_STORE_FILE = "shared_state.db"
+SNAPSHOT_DIR = "snapshots"              # Where the refreshing worker publishes sheet snapshots
+WORKER_BASE_PORT = 10100                # Worker N receives updates on port WORKER_BASE_PORT + N
+LOGIN_ATTEMPT_WINDOW_SECONDS = 900      # Failed login attempts are counted over this window
+SESSION_TTL_SECONDS = 12 * 3600         # Shared sessions (admin or teacher login) expire this long after their last change
+
+# Bulk payroll export
+EXPORT_WORKERS = 2          # Processes rendering slips
+EXPORT_BATCH_SIZE = 200     # Slips rendered per batch (bounds memory use)
+
+# Tracing and profiling
+SLOW_UPDATE_THRESHOLD_MS = 2000             # Updates slower than this are logged with their spans
+SLOW_UPDATE_LOG_FILE = "slow_updates.log"   # One JSON line per slow update
+PROFILE_MAX_SECONDS = 60                    # Longest /profile run allowed
+
+# Audit log
+AUDIT_FLUSH_SECONDS = 0.5                   # Queued audit events are written this often, in one transaction
+AUDIT_BATCH_SIZE = 1000                     # Most events written per transaction
+AUDIT_QUEUE_SIZE = 10000                    # Events beyond this are dropped (and counted) rather than blocking
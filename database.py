@@ -3,16 +3,19 @@ Database handler for storing teacher accounts and access codes
 """
 import threading
 import sqlite3
+import hashlib
+import json
 import secrets
 import string
 import os
-import shutil
 from datetime import datetime
-from typing import Optional, List, Tuple
-from config import DATABASE_FILE, ACCESS_CODE_LENGTH, BACKUP_DIR, BACKUP_ENABLED
+from typing import Optional, List, Tuple, Dict
+from config import DATABASE_FILE, ACCESS_CODE_LENGTH, BACKUP_DIR, BACKUP_ENABLED, DEFAULT_BRANCH
+from tracing import trace_methods
 
 
 
+@trace_methods("db")
 class Database:
     def __init__(self):
         self.db_file = DATABASE_FILE
@@ -32,17 +35,90 @@ class Database:
         cursor = conn.cursor()
         
         # Create teachers table
-        cursor.execute('''
+        cursor.execute(f'''
             CREATE TABLE IF NOT EXISTS teachers (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL UNIQUE,
                 access_code TEXT NOT NULL UNIQUE,
                 failed_attempts INTEGER DEFAULT 0,
                 is_blocked INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                branch TEXT NOT NULL DEFAULT '{DEFAULT_BRANCH}'
             )
         ''')
-        
+
+        # Databases created before branches existed get the column added
+        cursor.execute('PRAGMA table_info(teachers)')
+        if 'branch' not in {row[1] for row in cursor.fetchall()}:
+            try:
+                cursor.execute(f"ALTER TABLE teachers ADD COLUMN branch TEXT NOT NULL DEFAULT '{DEFAULT_BRANCH}'")
+            except sqlite3.OperationalError as e:
+                # Another worker starting at the same time added it first
+                if "duplicate column" not in str(e):
+                    raise
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_teachers_branch ON teachers (branch)')
+
+        # Case-insensitive index on name for prefix search and keyset paging
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_teachers_name_nocase
+            ON teachers (name COLLATE NOCASE)
+        ''')
+
+        # Trigram index for substring search (needs SQLite >= 3.34 with FTS5)
+        try:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'teachers_fts'")
+            fts_exists = cursor.fetchone() is not None
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS teachers_fts
+                USING fts5(name, content='teachers', content_rowid='id', tokenize='trigram')
+            ''')
+            cursor.executescript('''
+                CREATE TRIGGER IF NOT EXISTS teachers_fts_insert AFTER INSERT ON teachers BEGIN
+                    INSERT INTO teachers_fts (rowid, name) VALUES (new.id, new.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS teachers_fts_delete AFTER DELETE ON teachers BEGIN
+                    INSERT INTO teachers_fts (teachers_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS teachers_fts_update AFTER UPDATE OF name ON teachers BEGIN
+                    INSERT INTO teachers_fts (teachers_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO teachers_fts (rowid, name) VALUES (new.id, new.name);
+                END;
+            ''')
+            if not fts_exists:
+                # Index teachers created before the search index existed
+                cursor.execute("INSERT INTO teachers_fts (teachers_fts) VALUES ('rebuild')")
+            self.has_trigram_index = True
+        except sqlite3.OperationalError:
+            self.has_trigram_index = False
+
+        # Salary archive: parsed rows stored once by content hash, and which
+        # row each teacher had in each month
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS salary_rows (
+                hash TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS salary_history (
+                branch TEXT NOT NULL,
+                teacher_key TEXT NOT NULL,
+                month TEXT NOT NULL,
+                row_hash TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (branch, teacher_key, month)
+            )
+        ''')
+        # Month each sheet tab holds, fixed when the tab is first fetched
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sheet_tabs (
+                spreadsheet_id TEXT NOT NULL,
+                sheet_gid TEXT NOT NULL,
+                month TEXT NOT NULL,
+                PRIMARY KEY (spreadsheet_id, sheet_gid)
+            )
+        ''')
+
         conn.commit()
         conn.close()
 
@@ -63,8 +139,8 @@ class Database:
         conn.close()
         return exists
 
-    def create_teacher(self, name: str) -> Optional[str]:
-        """Create a new teacher account and return the access code"""
+    def create_teacher(self, name: str, branch: str = DEFAULT_BRANCH) -> Optional[str]:
+        """Create a new teacher account in a branch and return the access code"""
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
         
@@ -80,9 +156,9 @@ class Database:
             
             # Insert teacher
             cursor.execute('''
-                INSERT INTO teachers (name, access_code)
-                VALUES (?, ?)
-            ''', (name, access_code))
+                INSERT INTO teachers (name, access_code, branch)
+                VALUES (?, ?, ?)
+            ''', (name, access_code, branch))
             
             conn.commit()
             conn.close()
@@ -101,19 +177,19 @@ class Database:
         conn.close()
         return deleted
 
-    def get_teacher_by_code(self, access_code: str) -> Optional[Tuple[int, str]]:
-        """Get teacher ID and name by access code. Returns (id, name) or None"""
+    def get_teacher_by_code(self, access_code: str) -> Optional[Tuple[int, str, str]]:
+        """Get teacher ID, name and branch by access code. Returns (id, name, branch) or None"""
         conn = sqlite3.connect(self.db_file)
         cursor = conn.cursor()
-        cursor.execute('SELECT id, name, is_blocked FROM teachers WHERE access_code = ?', (access_code,))
+        cursor.execute('SELECT id, name, is_blocked, branch FROM teachers WHERE access_code = ?', (access_code,))
         result = cursor.fetchone()
         conn.close()
         
         if result:
-            teacher_id, name, is_blocked = result
+            teacher_id, name, is_blocked, branch = result
             if is_blocked:
                 return None  # Teacher is blocked
-            return (teacher_id, name)
+            return (teacher_id, name, branch)
         return None
 
     def reset_access_code(self, name: str) -> Optional[str]:
@@ -187,6 +263,153 @@ class Database:
         conn.close()
         return teachers
 
+    def get_teachers_page(self, after: Optional[Tuple[str, int]] = None, before: Optional[Tuple[str, int]] = None,
+                          limit: int = 10) -> Tuple[List[Tuple[int, str]], bool]:
+        """Get one page of teachers ordered by name, then id (keyset pagination).
+
+        Pass the (name, id) of the last teacher on the current page as `after` for
+        the next page, or of the first one as `before` for the previous page. The
+        id keeps names that differ only in case apart. Returns (rows, has_more)
+        where rows is a list of (id, name) and has_more tells if there is another
+        page in the same direction.
+        """
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        if before is not None:
+            cursor.execute('''
+                SELECT id, name FROM teachers
+                WHERE name COLLATE NOCASE <= ? AND (name COLLATE NOCASE < ? OR id < ?)
+                ORDER BY name COLLATE NOCASE DESC, id DESC
+                LIMIT ?
+            ''', (before[0], before[0], before[1], limit + 1))
+        elif after is not None:
+            cursor.execute('''
+                SELECT id, name FROM teachers
+                WHERE name COLLATE NOCASE >= ? AND (name COLLATE NOCASE > ? OR id > ?)
+                ORDER BY name COLLATE NOCASE, id
+                LIMIT ?
+            ''', (after[0], after[0], after[1], limit + 1))
+        else:
+            cursor.execute('''
+                SELECT id, name FROM teachers
+                ORDER BY name COLLATE NOCASE, id
+                LIMIT ?
+            ''', (limit + 1,))
+        rows = cursor.fetchall()
+        conn.close()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+        return rows, has_more
+
+    def search_teachers(self, query: str, limit: int = 10) -> List[Tuple[int, str]]:
+        """Search teachers by name prefix, then by substring. Returns list of (id, name)"""
+        query = query.strip()
+        if not query:
+            return []
+
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+
+        # Prefix match is a range scan over the name index
+        cursor.execute('''
+            SELECT id, name FROM teachers
+            WHERE name COLLATE NOCASE >= ? AND name COLLATE NOCASE < ?
+            ORDER BY name COLLATE NOCASE
+            LIMIT ?
+        ''', (query, query + "\uffff", limit))
+        results = cursor.fetchall()
+
+        # Fill the rest with substring matches from the trigram index
+        if len(results) < limit and len(query) >= 3 and self.has_trigram_index:
+            seen = {teacher_id for teacher_id, _ in results}
+            phrase = '"' + query.replace('"', '""') + '"'
+            cursor.execute('''
+                SELECT t.id, t.name FROM teachers_fts f
+                JOIN teachers t ON t.id = f.rowid
+                WHERE teachers_fts MATCH ?
+                ORDER BY t.name COLLATE NOCASE
+                LIMIT ?
+            ''', (phrase, limit + len(seen)))
+            for teacher_id, name in cursor.fetchall():
+                if teacher_id not in seen and len(results) < limit:
+                    results.append((teacher_id, name))
+
+        conn.close()
+        return results
+
+    def get_teacher_by_id(self, teacher_id: int) -> Optional[Tuple[str, str, int, str]]:
+        """Get teacher by ID. Returns (name, access_code, is_blocked, branch) or None"""
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute('SELECT name, access_code, is_blocked, branch FROM teachers WHERE id = ?', (teacher_id,))
+        result = cursor.fetchone()
+        conn.close()
+        return result
+
+    def get_sheet_month(self, spreadsheet_id: str, sheet_gid: str) -> str:
+        """Month a sheet tab holds: the month it was first seen in, remembered from then on"""
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO sheet_tabs (spreadsheet_id, sheet_gid, month) VALUES (?, ?, ?)
+        ''', (spreadsheet_id, str(sheet_gid), datetime.now().strftime("%Y-%m")))
+        cursor.execute(
+            'SELECT month FROM sheet_tabs WHERE spreadsheet_id = ? AND sheet_gid = ?',
+            (spreadsheet_id, str(sheet_gid))
+        )
+        month = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+        return month
+
+    def archive_salary_rows(self, branch: str, month: str, rows: List[Dict]) -> int:
+        """Store a refreshed sheet's parsed rows for a month. Returns the number of rows written
+
+        Rows are content-addressed, so a row that is the same as in an earlier
+        refresh is stored only once.
+        """
+        row_records = []
+        history_records = []
+        for row in rows:
+            data = json.dumps(row, sort_keys=True, ensure_ascii=False)
+            row_hash = hashlib.sha256(data.encode("utf-8")).hexdigest()
+            row_records.append((row_hash, data))
+            history_records.append((branch, row["name"].strip().lower(), month, row_hash))
+
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR IGNORE INTO salary_rows (hash, data) VALUES (?, ?)', row_records)
+        cursor.executemany('''
+            INSERT INTO salary_history (branch, teacher_key, month, row_hash)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (branch, teacher_key, month) DO UPDATE
+            SET row_hash = excluded.row_hash, updated_at = CURRENT_TIMESTAMP
+            WHERE row_hash != excluded.row_hash
+        ''', history_records)
+        changed = conn.total_changes
+        conn.commit()
+        conn.close()
+        return changed
+
+    def get_salary_history(self, teacher_name: str, branch: str = DEFAULT_BRANCH,
+                           limit: int = 6) -> List[Tuple[str, Dict]]:
+        """Get a teacher's archived salary data, newest month first. Returns list of (month, data)"""
+        conn = sqlite3.connect(self.db_file)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT h.month, r.data FROM salary_history h
+            JOIN salary_rows r ON r.hash = h.row_hash
+            WHERE h.branch = ? AND h.teacher_key = ?
+            ORDER BY h.month DESC
+            LIMIT ?
+        ''', (branch, teacher_name.strip().lower(), limit))
+        history = [(month, json.loads(data)) for month, data in cursor.fetchall()]
+        conn.close()
+        return history
+
     def unblock_teacher(self, name: str) -> bool:
         """Unblock a teacher account"""
         conn = sqlite3.connect(self.db_file)
@@ -215,8 +438,15 @@ class Database:
             backup_filename = f"teachers_backup_{timestamp}.db"
             backup_path = os.path.join(self.backup_dir, backup_filename)
             
-            # Copy database file
-            shutil.copy2(self.db_file, backup_path)
+            # SQLite's online backup gives a consistent copy even while the
+            # audit log and other workers are writing (a file copy could be torn)
+            source = sqlite3.connect(self.db_file, timeout=10)
+            target = sqlite3.connect(backup_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
             
             # Keep only last 10 backups (optional cleanup)
             self._cleanup_old_backups()
@@ -0,0 +1,110 @@
+"""
+Bulk payroll export: a CSV of all teachers and one text slip per teacher, in one ZIP
+"""
+import csv
+import io
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Tuple
+import config
+from sheets_handler import SALARY_FIELDS, TEXT_FIELDS, format_field
+
+
+def csv_value(data: Dict[str, any], key: str):
+    """Amounts go to the CSV as plain numbers so spreadsheets can sum them"""
+    value = data[key]
+    if key not in TEXT_FIELDS and isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def render_slip(item: Tuple[int, Dict[str, any], str]) -> Tuple[str, list, str]:
+    """Render one teacher. Runs in a pool process. Returns (slip filename, csv row, slip text)"""
+    index, data, title = item
+    safe_name = re.sub(r"[^\w\-]+", "_", data["name"]).strip("_") or "teacher"
+    slip = "\n".join(
+        [title, ""] + [f"{label}: {format_field(data, key)}" for key, _, label in SALARY_FIELDS]
+    ) + "\n"
+    csv_row = [csv_value(data, key) for key, _, _ in SALARY_FIELDS]
+    return f"{index:04d}_{safe_name}.txt", csv_row, slip
+
+
+# One pool for the life of the bot, started on the first export
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _pool_context():
+    # Never fork the bot itself: its threads may hold locks at fork time. forkserver
+    # forks pool processes from a clean server that has only this module imported
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["export"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.EXPORT_WORKERS, mp_context=_pool_context())
+        return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor):
+    """A pool process died; the next export starts a new pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+
+def export_payroll(rows: List[Dict[str, any]], branch: str, month: str) -> str:
+    """Write the export ZIP to a temporary file and return its path. The caller deletes it.
+
+    Slips are rendered in a process pool one batch at a time and written
+    straight into the archive, so memory stays bounded by the batch size.
+    """
+    title = f"Payroll slip - {branch} - {month}"
+    fd, zip_path = tempfile.mkstemp(prefix=f"payroll_{branch}_{month}_", suffix=".zip")
+    os.close(fd)
+
+    pool = _get_pool()
+    try:
+        with tempfile.TemporaryFile() as csv_file, \
+                zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            # utf-8-sig so Excel opens non-Latin names correctly
+            csv_text = io.TextIOWrapper(csv_file, encoding="utf-8-sig", newline="")
+            writer = csv.writer(csv_text)
+            writer.writerow([label for _, _, label in SALARY_FIELDS])
+
+            batch_size = config.EXPORT_BATCH_SIZE
+            for start in range(0, len(rows), batch_size):
+                batch = [(i, data, title) for i, data in enumerate(rows[start:start + batch_size], start + 1)]
+                for filename, csv_row, slip in pool.map(render_slip, batch):
+                    writer.writerow(csv_row)
+                    archive.writestr(f"slips/{filename}", slip)
+
+            # The CSV was spooled to disk; copy it in now that no other entry is open
+            csv_text.flush()
+            csv_file.seek(0)
+            with archive.open("payroll.csv", "w") as entry:
+                shutil.copyfileobj(csv_file, entry)
+            csv_text.detach()
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        os.remove(zip_path)
+        raise
+    except Exception:
+        os.remove(zip_path)
+        raise
+
+    return zip_path
@@ -1,32 +1,355 @@
+import contextvars
 import csv
+import logging
+import random
+import threading
+import time
 import requests
-from typing import Optional, Dict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional, Dict, List, Callable, Tuple
 import config
+from snapshot import SheetSnapshot
+from tracing import traced
+
+logger = logging.getLogger(__name__)
+
+# Fields of a salary slip in display order: (key, emoji, label)
+SALARY_FIELDS = [
+    ("name", "👤", "Name"),
+    ("share", "📊", "Share"),
+    ("salary", "💰", "Salary"),
+    ("advance", "💸", "Advance"),
+    ("bonus", "🎁", "Bonus"),
+    ("penalty", "⚠️", "Penalty"),
+    ("cover_minus", "➖", "Cover Minus"),
+    ("cover_plus", "➕", "Cover Plus"),
+    ("tax", "🏦", "TAX"),
+    ("remains", "🏁", "Net Remains"),
+]
+# Fields shown as they are; all others are amounts
+TEXT_FIELDS = ("name", "share")
+
+def format_field(data: Dict[str, any], key: str) -> str:
+    return str(data[key]) if key in TEXT_FIELDS else format_amount(data[key])
+
+def format_amount(val) -> str:
+    """Format a number like 11 107 427, or return it unchanged if it isn't one"""
+    try:
+        return f"{int(float(val)):,}".replace(",", " ")
+    except:
+        return str(val)
+
+class SheetFetchError(Exception):
+    """The sheet could not be fetched within the request's deadline"""
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for a while, then lets one trial call through.
+
+    A trial that reports neither success nor failure within trial_seconds is
+    considered lost, and the next caller gets a new trial.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = config.BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = config.BREAKER_RESET_SECONDS,
+                 trial_seconds: float = config.SHEET_FETCH_DEADLINE_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.trial_seconds = trial_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go through now"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.reset_seconds:
+                    return False
+            elif self.state == self.HALF_OPEN:
+                # Only the single trial call is allowed, unless it got lost
+                if now - self.trial_started_at < self.trial_seconds:
+                    return False
+            else:
+                return True
+            self.state = self.HALF_OPEN
+            self.trial_started_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def status(self) -> Dict[str, any]:
+        with self._lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(self.reset_seconds - (time.monotonic() - self.opened_at), 0)
+            return {"state": self.state, "failures": self.failures, "retry_in": retry_in}
+
 
 class SheetsHandler:
-    def __init__(self):
-        self.spreadsheet_id = config.SPREADSHEET_ID
+    """Fetches and caches one branch's payroll sheet"""
+
+    def __init__(self, branch: str = config.DEFAULT_BRANCH, snapshot: Optional[SheetSnapshot] = None,
+                 on_refresh: Optional[Callable[["SheetsHandler", list], None]] = None):
+        settings = config.BRANCHES[branch]
+        self.branch = branch
+        self.month = settings.get("month")
+        self.spreadsheet_id = settings["spreadsheet_id"]
+        self.sheet_gid = settings["sheet_gid"]
+        self.refresh_seconds = settings.get("refresh_seconds", config.SHEET_REFRESH_SECONDS)
+        self.last_used = time.monotonic()
+        # Set when several workers share sheets through published snapshot files
+        self.snapshot = snapshot
+        # Called with (handler, rows) whenever a fetch returns changed sheet data
+        self.on_refresh = on_refresh
+
+        self.breaker = CircuitBreaker()
+
+        self._data = None
+        self._fetched_at = 0.0
+        self._fetched_wall = 0.0
+        # Appended from request threads while fetches and status() read it
+        self._latencies = deque(maxlen=50)
+        self._latencies_lock = threading.Lock()
+        max_fetches = settings.get("max_concurrent_fetches", config.SHEET_MAX_CONCURRENT_FETCHES)
+        self._fetch_slots = threading.BoundedSemaphore(max_fetches)
+        # This branch's own request threads, so a slow branch can't starve the others: two per
+        # fetch (request and hedge), and as many for losing requests of earlier fetches
+        self._request_pool = ThreadPoolExecutor(max_workers=4 * max_fetches,
+                                                thread_name_prefix=f"sheet-request-{branch}")
+
+    def _is_fresh(self) -> bool:
+        return self._data is not None and time.monotonic() - self._fetched_at < self.refresh_seconds
+
+    @traced("sheets.request")
+    def _request(self, timeout: float) -> list:
+        """One HTTP request for the sheet's CSV export"""
+        started = time.monotonic()
+        url = f"https://docs.google.com/spreadsheets/d/{self.spreadsheet_id}/export?format=csv&gid={self.sheet_gid}"
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        with self._latencies_lock:
+            self._latencies.append(time.monotonic() - started)
+        return list(csv.reader(response.content.decode("utf-8").splitlines()))
 
-    def get_all_data(self) -> list:
+    def _hedge_delay(self) -> float:
+        """How long to wait before sending a second request: the configured latency percentile"""
+        with self._latencies_lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < 5:
+            return config.SHEET_HEDGE_DEFAULT_SECONDS
+        index = min(int(len(latencies) * config.SHEET_HEDGE_PERCENTILE / 100), len(latencies) - 1)
+        return max(latencies[index], config.SHEET_HEDGE_MIN_SECONDS)
+
+    def _hedged_request(self, timeout: float) -> list:
+        """Send a request; if it is slower than usual, send a second one and use whichever answers first"""
+        deadline = time.monotonic() + timeout
+        pending = {self._request_pool.submit(contextvars.copy_context().run, self._request, timeout)}
+        hedge_delay = self._hedge_delay()
+        hedged = False
+        error = None
         try:
-            url = f"https://docs.google.com/spreadsheets/d/{self.spreadsheet_id}/export?format=csv&gid={config.SHEET_GID}"
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            return list(csv.reader(response.content.decode("utf-8").splitlines()))
-        except Exception as e:
-            raise Exception(f"Connection Error: {str(e)}")
-
-    def find_teacher_row(self, teacher_name: str) -> Optional[Dict[str, any]]:
-        data = self.get_all_data()
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, pending = wait(pending, timeout=remaining if hedged else min(hedge_delay, remaining),
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        error = e
+                if not done and not hedged:
+                    hedged = True
+                    remaining = deadline - time.monotonic()
+                    pending.add(self._request_pool.submit(contextvars.copy_context().run, self._request, remaining))
+        finally:
+            # Requests still queued behind other fetches aren't sent at all
+            for future in pending:
+                future.cancel()
+        raise error or SheetFetchError("Sheet request timed out")
+
+    @traced("sheets.fetch")
+    def _fetch(self, deadline: Optional[float] = None) -> list:
+        """Fetch the sheet before the deadline (a time.monotonic() value).
+
+        Failed requests are retried after a jittered backoff while the deadline
+        allows. While the circuit breaker is open nothing is sent at all.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + config.SHEET_FETCH_DEADLINE_SECONDS
+        last_error = None
+        for attempt in range(config.SHEET_FETCH_RETRIES):
+            # Checked before allow(): a half-open breaker's trial must be followed by a request
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.breaker.allow():
+                raise SheetFetchError("Google Sheets is unavailable (circuit breaker open)")
+            try:
+                data = self._hedged_request(remaining)
+            except Exception as e:
+                self.breaker.record_failure()
+                last_error = e
+                if attempt + 1 == config.SHEET_FETCH_RETRIES:
+                    break
+                # Full jitter: wait a random time up to base * 2^attempt
+                backoff = random.uniform(0, config.SHEET_RETRY_BASE_SECONDS * 2 ** attempt)
+                if time.monotonic() + backoff >= deadline:
+                    break
+                time.sleep(backoff)
+                continue
+            self.breaker.record_success()
+            return data
+        raise SheetFetchError(f"Could not fetch the sheet: {last_error or 'deadline exceeded'}")
+
+    @traced("sheets.get_all_data")
+    def get_all_data(self, deadline_seconds: Optional[float] = None) -> Tuple[list, Optional[float]]:
+        """Get the sheet rows, fetching them when the cached copy is due.
+
+        Fetching gives up after deadline_seconds (default SHEET_FETCH_DEADLINE_SECONDS).
+        If it fails, the last data we have is returned instead; SheetFetchError is
+        raised only when there is no earlier data at all.
+
+        Returns (rows, stale_age): stale_age is None for current data, or how many
+        seconds old the rows are when they had to be answered from older data.
+        """
+        self.last_used = time.monotonic()
+        deadline = time.monotonic() + (deadline_seconds or config.SHEET_FETCH_DEADLINE_SECONDS)
+        if self.snapshot is not None:
+            self.snapshot.mark_wanted()
+            # A snapshot that stopped being refreshed (refresher died) is ignored
+            data = self.snapshot.read(max_age_seconds=self.refresh_seconds * 3)
+            if data is not None:
+                return data, None
+
+        if self._is_fresh():
+            return self._data, None
+
+        if not self._fetch_slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            return self._fallback(SheetFetchError("Timed out waiting for another fetch of the sheet"))
+        try:
+            # Another request may have refreshed the sheet while we waited for a slot
+            if self._is_fresh():
+                return self._data, None
+            data = self._fetch(deadline)
+        except SheetFetchError as e:
+            return self._fallback(e)
+        finally:
+            self._fetch_slots.release()
+        self._remember(data)
+        return data, None
+
+    def _fallback(self, error: SheetFetchError) -> Tuple[list, float]:
+        """Answer from the last data we have, however old, or raise the fetch error.
+        Returns (rows, seconds since they were fetched)"""
+        data, fetched_wall = self._data, self._fetched_wall
+        if data is not None:
+            age = time.time() - fetched_wall
+        elif self.snapshot is not None:
+            data = self.snapshot.read(max_age_seconds=float("inf"))
+            age = self.snapshot.age()
+        if data is None:
+            raise error
+        logger.warning(f"Serving stale sheet data for branch {self.branch}: {error}")
+        return data, age or 0.0
+
+    def data_age(self) -> Optional[float]:
+        """Seconds since the data we serve was fetched, or None if we have none"""
+        ages = []
+        if self._data is not None:
+            ages.append(time.time() - self._fetched_wall)
+        if self.snapshot is not None and self.snapshot.age() is not None:
+            ages.append(self.snapshot.age())
+        return min(ages) if ages else None
+
+    def status(self) -> Dict[str, any]:
+        """Circuit breaker state and data freshness, for admins"""
+        return {**self.breaker.status(), "data_age": self.data_age(), "hedge_after": self._hedge_delay()}
+
+    def refresh_snapshot(self) -> bool:
+        """Fetch the sheet and publish it for other workers if the snapshot is due.
+
+        Only branches that someone asked for recently are refreshed. Returns True
+        if a snapshot was published.
+        """
+        if self.snapshot is None or not self.snapshot.wanted_within(config.SHEET_IDLE_EVICT_SECONDS):
+            return False
+        age = self.snapshot.age()
+        if age is not None and age < self.refresh_seconds:
+            return False
+
+        with self._fetch_slots:
+            data = self._fetch()
+        self.snapshot.publish(data)
+        self._remember(data)
+        # Keeps the refresher's handler (breaker state, latencies) from being evicted as idle
+        self.last_used = time.monotonic()
+        return True
+
+    def _remember(self, data: list):
+        changed = data != self._data
+        self._data = data
+        self._fetched_at = time.monotonic()
+        self._fetched_wall = time.time()
+        if changed and self.on_refresh is not None:
+            try:
+                self.on_refresh(self, data)
+            except Exception as e:
+                logger.warning(f"Refresh hook failed for branch {self.branch}: {e}")
+
+    def find_teacher_row(self, teacher_name: str) -> Tuple[Optional[Dict[str, any]], Optional[float]]:
+        """Find a teacher's salary data. Returns (data or None, stale_age as in get_all_data)"""
+        data, stale_age = self.get_all_data()
         name_col = config.COLUMN_MAPPING.get("name", 0)
         search_name = teacher_name.lower().strip()
         
         for row in data:
             if len(row) > name_col and row[name_col].strip().lower() == search_name:
                 print(f"DEBUG: Found row for {teacher_name}: {row}")
-                return self._extract_salary_data(row, teacher_name)
-        return None
+                return self._extract_salary_data(row, teacher_name), stale_age
+        return None, stale_age
 
+    def extract_all_rows(self, data: list) -> List[Dict[str, any]]:
+        """Parse every teacher row into salary data (header, label and total rows are skipped)"""
+        name_col = config.COLUMN_MAPPING.get("name", 0)
+        return [
+            self._extract_salary_data(row, row[name_col].strip())
+            for row in data
+            if self._is_teacher_row(row)
+        ]
+
+    def _is_teacher_row(self, row: list) -> bool:
+        """A teacher row has a name that isn't a total, and at least one amount column with a number"""
+        name_col = config.COLUMN_MAPPING.get("name", 0)
+        if len(row) <= name_col:
+            return False
+        name = row[name_col].strip()
+        if not name or name.lower() in config.SUMMARY_ROW_NAMES:
+            return False
+        amount_cols = [idx for key, idx in config.COLUMN_MAPPING.items() if key not in TEXT_FIELDS]
+        return any(idx < len(row) and any(c.isdigit() for c in row[idx]) for idx in amount_cols)
+
+    @traced("sheets.extract_salary_data")
     def _extract_salary_data(self, row: list, teacher_name: str) -> Dict[str, any]:
         m = config.COLUMN_MAPPING
         
@@ -67,21 +390,69 @@ class SheetsHandler:
             "remains": clean_number("remains"),
         }
     def format_salary_message(self, data: Dict[str, any]) -> str:
-        def f(val):
+        return "\n".join(
+            f"{emoji} **{label}:** {format_field(data, key)}" for key, emoji, label in SALARY_FIELDS
+        )
+
+
+class SheetsRegistry:
+    """Per-branch SheetsHandlers, created on first request for a branch"""
+
+    def __init__(self, branches: Optional[Dict[str, dict]] = None, snapshot_dir: Optional[str] = None,
+                 on_refresh: Optional[Callable[[SheetsHandler, list], None]] = None):
+        self.branches = branches if branches is not None else config.BRANCHES
+        self.snapshot_dir = snapshot_dir
+        self.on_refresh = on_refresh
+        self._handlers: Dict[str, SheetsHandler] = {}
+        self._lock = threading.Lock()
+
+    def branch_ids(self) -> List[str]:
+        return list(self.branches)
+
+    def get(self, branch: Optional[str] = None) -> SheetsHandler:
+        """Get the handler for a branch. Raises KeyError for unknown branches"""
+        branch = branch or config.DEFAULT_BRANCH
+        if branch not in self.branches:
+            raise KeyError(f"Unknown branch: {branch}")
+        with self._lock:
+            handler = self._handlers.get(branch)
+            if handler is None:
+                snapshot = SheetSnapshot(self.snapshot_dir, branch) if self.snapshot_dir else None
+                handler = SheetsHandler(branch, snapshot, self.on_refresh)
+                self._handlers[branch] = handler
+            return handler
+
+    def refresh_snapshots(self) -> List[str]:
+        """Refresh due snapshots of all branches. Returns the branches published"""
+        published = []
+        if self.snapshot_dir is None:
+            return published
+        for branch in self.branch_ids():
+            with self._lock:
+                has_handler = branch in self._handlers
+            # Don't create handlers for branches no worker has asked for
+            wanted = SheetSnapshot(self.snapshot_dir, branch).wanted_within(config.SHEET_IDLE_EVICT_SECONDS)
+            if not has_handler and not wanted:
+                continue
             try:
-                return f"{int(float(val)):,}".replace(",", " ")
-            except:
-                return str(val)
-
-        return (
-            f"👤 **Name:** {data['name']}\n"
-            f"📊 **Share:** {data['share']}\n"
-            f"💰 **Salary:** {f(data['salary'])}\n"
-            f"💸 **Advance:** {f(data['advance'])}\n"
-            f"🎁 **Bonus:** {f(data['bonus'])}\n"
-            f"⚠️ **Penalty:** {f(data['penalty'])}\n"
-            f"➖ **Cover Minus:** {f(data['cover_minus'])}\n"
-            f"➕ **Cover Plus:** {f(data['cover_plus'])}\n"
-            f"🏦 **TAX:** {f(data['tax'])}\n"
-            f"🏁 **Net Remains:** {f(data['remains'])}"
-        )
\ No newline at end of file
+                if self.get(branch).refresh_snapshot():
+                    published.append(branch)
+            except Exception as e:
+                # Keep serving the previous snapshot; the next run will retry
+                logger.warning(f"Snapshot refresh failed for branch {branch}: {e}")
+        return published
+
+    def status(self) -> Dict[str, Dict[str, any]]:
+        """Status of every branch that currently has a handler"""
+        with self._lock:
+            handlers = dict(self._handlers)
+        return {branch: handler.status() for branch, handler in handlers.items()}
+
+    def evict_idle(self, max_idle_seconds: float) -> int:
+        """Drop handlers (and their cached sheets) unused for too long. Returns count dropped"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [b for b, h in self._handlers.items() if now - h.last_used > max_idle_seconds]
+            for branch in idle:
+                del self._handlers[branch]
+        return len(idle)
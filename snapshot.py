@@ -0,0 +1,136 @@
+"""
+Versioned sheet snapshots shared between worker processes.
+
+One worker (whoever holds the refresh lock) fetches a branch's sheet and
+publishes it as a snapshot file; the other workers read that file instead
+of fetching the sheet themselves. Each worker parses a snapshot version once
+and keeps the rows until a new version is published.
+
+File layout: one JSON header line, then one JSON array per sheet row.
+"""
+import hashlib
+import json
+import os
+import time
+from typing import List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to electing worker 0
+    fcntl = None
+
+
+class SheetSnapshot:
+    """One branch's snapshot file"""
+
+    # Don't touch the "wanted" marker more often than this (seconds)
+    WANTED_TOUCH_INTERVAL = 5
+
+    def __init__(self, directory: str, branch: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{branch}.snap")
+        self.wanted_path = os.path.join(directory, f"{branch}.wanted")
+        self._file_id = None
+        self._header = None
+        self._rows = None
+        self._wanted_touched_at = 0.0
+
+    def publish(self, rows: List[list]) -> int:
+        """Atomically replace the snapshot. Returns the published version.
+
+        The version only changes when the rows do, so readers don't re-parse
+        an unchanged sheet.
+        """
+        body = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()
+        current = self._read_header()
+        if current and current["digest"] == digest:
+            version = current["version"]
+        else:
+            version = time.time_ns()
+
+        header = {"version": version, "digest": digest, "published_at": time.time(), "rows": len(rows)}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return version
+
+    def read(self, max_age_seconds: float) -> Optional[List[list]]:
+        """Get the snapshot rows, or None if there is none or it is too old"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        file_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if file_id != self._file_id:
+            with open(self.path, "rb") as f:
+                header = json.loads(f.readline())
+                if self._header is None or header["version"] != self._header["version"]:
+                    self._rows = [json.loads(line) for line in f]
+            self._header = header
+            self._file_id = file_id
+
+        if time.time() - self._header["published_at"] > max_age_seconds:
+            return None
+        return self._rows
+
+    def _read_header(self) -> Optional[dict]:
+        try:
+            with open(self.path, "rb") as f:
+                return json.loads(f.readline())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def mark_wanted(self):
+        """Record that a user asked for this branch, so the refresher keeps it fresh"""
+        now = time.time()
+        if now - self._wanted_touched_at < self.WANTED_TOUCH_INTERVAL:
+            return
+        with open(self.wanted_path, "a"):
+            os.utime(self.wanted_path)
+        self._wanted_touched_at = now
+
+    def wanted_within(self, seconds: float) -> bool:
+        try:
+            return time.time() - os.path.getmtime(self.wanted_path) <= seconds
+        except FileNotFoundError:
+            return False
+
+    def age(self) -> Optional[float]:
+        """Seconds since the snapshot was last published, or None if there is none"""
+        header = self._read_header()
+        return time.time() - header["published_at"] if header else None
+
+
+class RefreshLock:
+    """Non-blocking file lock that elects one worker to refresh snapshots.
+
+    The lock is held until the process exits, so another worker takes over
+    only if the current refresher dies.
+    """
+
+    def __init__(self, path: str, worker_index: int = 0):
+        self.path = path
+        self.worker_index = worker_index
+        self._fd = None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            return self.worker_index == 0
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
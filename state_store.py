@@ -0,0 +1,141 @@
+"""
+Session and login-attempt storage shared by bot workers
+"""
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+import config
+
+
+class MemoryStateStore:
+    """Keeps sessions in this process only (single worker)"""
+
+    def __init__(self):
+        self._sessions: Dict[int, dict] = {}
+        self._attempts: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> dict:
+        """Get a copy of the user's session, or an empty dict"""
+        with self._lock:
+            return dict(self._sessions.get(user_id, {}))
+
+    def set(self, user_id: int, session: dict):
+        with self._lock:
+            self._sessions[user_id] = dict(session)
+
+    def delete(self, user_id: int):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def increment_attempts(self, user_id: int) -> int:
+        """Count a failed login attempt. Returns attempts within the current window"""
+        now = time.time()
+        with self._lock:
+            count, first_at = self._attempts.get(user_id, (0, now))
+            if now - first_at > config.LOGIN_ATTEMPT_WINDOW_SECONDS:
+                count, first_at = 0, now
+            self._attempts[user_id] = (count + 1, first_at)
+            return count + 1
+
+    def reset_attempts(self, user_id: int):
+        with self._lock:
+            self._attempts.pop(user_id, None)
+
+
+class FileStateStore:
+    """Keeps sessions in a SQLite file so several worker processes share them"""
+
+    def __init__(self, path: str = config.STATE_STORE_FILE):
+        self.path = path
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS login_attempts (
+                user_id INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL,
+                first_at REAL NOT NULL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, user_id: int) -> dict:
+        """Get the user's session, or an empty dict if there is none or it expired"""
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT data FROM sessions WHERE user_id = ? AND updated_at > ?',
+            (user_id, time.time() - config.SESSION_TTL_SECONDS)
+        ).fetchone()
+        conn.close()
+        return json.loads(row[0]) if row else {}
+
+    def set(self, user_id: int, session: dict):
+        conn = self._connect()
+        conn.execute('''
+            INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+        ''', (user_id, json.dumps(session), time.time()))
+        conn.commit()
+        conn.close()
+
+    def delete(self, user_id: int):
+        conn = self._connect()
+        conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+
+    def clear_sessions(self):
+        """Log everyone out. Done when the workers are (re)started, since their
+        conversation states don't survive a restart either"""
+        conn = self._connect()
+        conn.execute('DELETE FROM sessions')
+        conn.commit()
+        conn.close()
+
+    def increment_attempts(self, user_id: int) -> int:
+        """Count a failed login attempt. Returns attempts within the current window"""
+        now = time.time()
+        conn = self._connect()
+        conn.isolation_level = None
+        # IMMEDIATE takes the write lock up front so concurrent workers can't lose counts
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT count, first_at FROM login_attempts WHERE user_id = ?', (user_id,)).fetchone()
+        if row and now - row[1] <= config.LOGIN_ATTEMPT_WINDOW_SECONDS:
+            count, first_at = row[0] + 1, row[1]
+        else:
+            count, first_at = 1, now
+        conn.execute('''
+            INSERT OR REPLACE INTO login_attempts (user_id, count, first_at) VALUES (?, ?, ?)
+        ''', (user_id, count, first_at))
+        conn.execute('COMMIT')
+        conn.close()
+        return count
+
+    def reset_attempts(self, user_id: int):
+        conn = self._connect()
+        conn.execute('DELETE FROM login_attempts WHERE user_id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+
+
+def create_state_store(kind: Optional[str] = None):
+    """Build the state store selected by config.STATE_STORE ("memory" or "file")"""
+    kind = kind or config.STATE_STORE
+    if kind == "file":
+        return FileStateStore()
+    if kind == "memory":
+        return MemoryStateStore()
+    raise ValueError(f"Unknown STATE_STORE: {kind}")
@@ -0,0 +1,217 @@
+"""
+Per-update tracing spans and on-demand profiling.
+
+Each update handled by a @trace_update handler gets a trace. Code called
+while handling it (directly, or in threads started with asyncio.to_thread)
+records spans into that trace. Updates slower than
+config.SLOW_UPDATE_THRESHOLD_MS are written to config.SLOW_UPDATE_LOG_FILE
+as one JSON line each.
+"""
+import asyncio
+import contextvars
+import cProfile
+import functools
+import inspect
+import io
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+import config
+
+logger = logging.getLogger(__name__)
+slow_log = logging.getLogger("slow_updates")
+
+# Spans kept per trace; the rest are only counted
+MAX_SPANS = 200
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []
+        self.dropped_spans = 0
+
+    def add_span(self, name: str, start: float, end: float, error: str = None):
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped_spans += 1
+            return
+        span_record = {
+            "name": name,
+            "start_ms": round((start - self.start) * 1000, 1),
+            "ms": round((end - start) * 1000, 1),
+        }
+        if error:
+            span_record["error"] = error
+        self.spans.append(span_record)
+
+
+@contextmanager
+def span(name: str):
+    """Time a block as a span of the current trace (does nothing outside a trace)"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add_span(name, start, time.perf_counter(), error)
+
+
+def traced(name: str = None):
+    """Decorator recording every call of a function (sync or async) as a span"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_methods(prefix: str):
+    """Class decorator applying @traced to every public method, named prefix.method"""
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if callable(value) and not attr.startswith("_"):
+                setattr(cls, attr, traced(f"{prefix}.{attr}")(value))
+        return cls
+    return decorator
+
+
+def trace_update(handler):
+    """Decorator for bot handlers: the outermost handler starts the update's trace,
+    handlers it calls are recorded as spans"""
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        if _current_trace.get() is not None:
+            with span(handler.__name__):
+                return await handler(update, context, *args, **kwargs)
+
+        trace = Trace(handler.__name__)
+        token = _current_trace.set(trace)
+        error = None
+        try:
+            return await handler(update, context, *args, **kwargs)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            _current_trace.reset(token)
+            total_ms = (time.perf_counter() - trace.start) * 1000
+            if total_ms >= config.SLOW_UPDATE_THRESHOLD_MS:
+                _log_slow_update(trace, total_ms, update, error)
+    return wrapper
+
+
+def _log_slow_update(trace: Trace, total_ms: float, update, error: str = None):
+    if not slow_log.handlers:
+        handler = logging.FileHandler(config.SLOW_UPDATE_LOG_FILE, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        slow_log.addHandler(handler)
+        slow_log.propagate = False
+
+    user = getattr(update, "effective_user", None)
+    record = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "handler": trace.name,
+        "update_id": getattr(update, "update_id", None),
+        "user_id": user.id if user else None,
+        "total_ms": round(total_ms, 1),
+        "spans": trace.spans,
+    }
+    if trace.dropped_spans:
+        record["dropped_spans"] = trace.dropped_spans
+    if error:
+        record["error"] = error
+    slow_log.warning(json.dumps(record, ensure_ascii=False))
+    logger.warning(f"Slow update: {trace.name} took {total_ms:.0f} ms")
+
+
+# -------------------- PROFILING --------------------
+
+# Only one profile runs at a time
+_profiling = threading.Lock()
+
+
+async def run_cprofile(seconds: float, top: int = 40) -> str:
+    """Profile the event loop thread with cProfile for a while. Returns a text report"""
+    if not _profiling.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    finally:
+        _profiling.release()
+
+    out = io.StringIO()
+    out.write(f"cProfile of the event loop thread for {seconds:g}s\n\n")
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats("cumulative").print_stats(top)
+    return out.getvalue()
+
+
+def sample_stacks(seconds: float, interval: float = 0.005, top: int = 40) -> str:
+    """Sample the stacks of all other threads for a while. Returns a text report"""
+    if not _profiling.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+    try:
+        own = Counter()
+        total = Counter()
+        samples = 0
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                samples += 1
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                    if leaf:
+                        own[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        total[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+            time.sleep(interval)
+    finally:
+        _profiling.release()
+
+    lines = [f"Sampled all threads for {seconds:g}s: {samples} stack samples", ""]
+    for title, counts in (("Top functions by own samples", own), ("Top functions by total samples", total)):
+        lines.append(title)
+        for key, count in counts.most_common(top):
+            lines.append(f"{count:8d} {100 * count / max(samples, 1):6.1f}%  {key}")
+        lines.append("")
+    return "\n".join(lines)
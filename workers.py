@@ -0,0 +1,110 @@
+"""
+Run several bot workers on one machine behind a single Telegram poller.
+
+    python workers.py 4
+
+Starts 4 copies of bot.py as workers and polls Telegram here. Every update is
+forwarded to worker (user_id % N), so one user's conversation always lands on
+the same worker. Sessions and login attempts live in the shared state file and
+sheet data in published snapshots, so any worker can take over a user.
+"""
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import requests
+from dotenv import load_dotenv
+import config
+from database import Database
+from state_store import FileStateStore
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Update kinds that carry the sending user under "from"
+USER_UPDATE_KINDS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result")
+
+
+def update_user_id(update: dict) -> int:
+    for kind in USER_UPDATE_KINDS:
+        if kind in update and "from" in update[kind]:
+            return update[kind]["from"]["id"]
+    return 0
+
+
+def forward_update(update: dict, worker_count: int) -> bool:
+    """Send an update to its user's worker, or the next live one. Returns False if none took it"""
+    first = update_user_id(update) % worker_count
+    for offset in range(worker_count):
+        index = (first + offset) % worker_count
+        url = f"http://127.0.0.1:{config.WORKER_BASE_PORT + index}/telegram-update"
+        try:
+            response = requests.post(url, json=update, timeout=5)
+            if response.status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        logger.warning(f"Worker {index} did not accept update {update['update_id']}")
+    return False
+
+
+def start_workers(worker_count: int) -> list:
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    processes = []
+    for index in range(worker_count):
+        env = dict(os.environ, WORKER_INDEX=str(index), STATE_STORE="file")
+        processes.append(subprocess.Popen([sys.executable, bot_path], env=env, cwd=os.path.dirname(bot_path)))
+    return processes
+
+
+def poll_and_route(token: str, worker_count: int):
+    api = f"https://api.telegram.org/bot{token}"
+    offset = None
+    while True:
+        try:
+            response = requests.get(f"{api}/getUpdates", params={"timeout": 30, "offset": offset}, timeout=40)
+            response.raise_for_status()
+            updates = response.json().get("result", [])
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"getUpdates failed: {e}")
+            time.sleep(3)
+            continue
+
+        for update in updates:
+            if not forward_update(update, worker_count):
+                # Workers may still be starting; fetch the same updates again shortly
+                logger.error(f"No worker accepted update {update['update_id']}, retrying")
+                time.sleep(1)
+                break
+            offset = update["update_id"] + 1
+
+
+def main():
+    load_dotenv()
+    worker_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    # Create/migrate the database once here, not in N workers racing each other
+    Database()
+    FileStateStore().clear_sessions()
+    # Process managers stop us with SIGTERM; exit through the finally below so the
+    # workers don't outlive us holding their ports and the refresh lock
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    processes = start_workers(worker_count)
+    logger.info(f"Started {worker_count} workers")
+    try:
+        poll_and_route(os.getenv("BOT_TOKEN"), worker_count)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()